@@ -29,20 +29,56 @@ The input would be data/manifests/libritts-cuts_dev-other.jsonl.gz or
     (libritts_supervisions_dev-other.jsonl.gz and librittsrecordings_dev-other.jsonl.gz)
 
 The output would be data/fbank/libritts-cuts_dev-other.jsonl.gz
+
+For large datasets, split the manifest once beforehand, e.g.
+      lhotse split-lazy data/manifests/emilia_cuts_EN.jsonl.gz \
+        data/manifests/splits 10000
+
+and then compute the features of the splits in parallel:
+      python3 -m zipvoice.bin.compute_fbank \
+        --source-dir data/manifests/splits \
+        --dest-dir data/fbank/splits \
+        --dataset emilia \
+        --subset EN \
+        --split-cuts 1 \
+        --split-begin 0 \
+        --split-end 2000 \
+        --num-jobs 20
+
+Each worker only receives a split index and opens its own shard
+data/manifests/splits/emilia_cuts_EN.{idx}.jsonl.gz, so the full manifest
+is never pickled or scanned by the workers.
 """
 
 
 import argparse
+import hashlib
+import io
+import json
 import logging
+import math
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import threading
 from concurrent.futures import ProcessPoolExecutor as Pool
+from concurrent.futures import as_completed
+from functools import lru_cache
 from pathlib import Path
+from typing import FrozenSet, List, Optional
 
 import lhotse
+import soundfile
 import torch
-from lhotse import CutSet, LilcomChunkyWriter, load_manifest_lazy
+from lhotse import CutSet, LilcomChunkyWriter, Recording, load_manifest_lazy
+from lhotse.features.io import LilcomHdf5Writer
+from lhotse.utils import fastcopy
+from tqdm import tqdm
 
 from zipvoice.utils.common import str2bool
-from zipvoice.utils.feature import VocosFbank
+from zipvoice.utils.feature import VocosFbank, VocosFbankConfig
 
 # Torch's multithreaded behavior needs to be disabled or
 # it wastes a lot of CPU and slow things down.
@@ -53,6 +89,297 @@ torch.set_num_interop_threads(1)
 
 lhotse.set_audio_duration_mismatch_tolerance(0.1)
 
+try:
+    import psutil
+except Exception:
+    psutil = None
+
+
+STORAGE_TYPES = {
+    "lilcom_chunky": LilcomChunkyWriter,
+    "lilcom_hdf5": LilcomHdf5Writer,
+}
+
+
+# Extractors on CPU are created in the parent process before the worker pool
+# is forked, so that the workers share the mel filterbank and window instead of
+# each building their own. GPU workers build theirs once in _init_gpu_worker.
+@lru_cache(maxsize=None)
+def _get_extractor(type_: str, device: str = "cpu", use_bf16: bool = False):
+    if type_ == "vocos":
+        extractor = VocosFbank(device=device, use_bf16=use_bf16)
+    else:
+        raise NotImplementedError(f"{type_} is not supported")
+    if device == "cpu":
+        extractor.fbank.share_memory()
+        extractor.mel_fb.share_memory_()
+    return extractor
+
+
+# The number of DataLoader workers of each split job. The extractor is cheap
+# on GPU, so there the workers are just for audio loading.
+_NUM_LOADER_WORKERS_GPU = 2
+_NUM_LOADER_WORKERS_CPU = 4
+# The default prefetch_factor of the DataLoader in compute_and_store_features_batch.
+_PREFETCH_FACTOR = 2
+
+# The GPU that the current worker process is bound to, set by _init_gpu_worker.
+_WORKER_DEVICE = None
+
+_LOG_FORMAT = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+
+def _get_worker_rank(counter) -> int:
+    """Returns a rank that is unique among the workers of a pool, from a
+    counter shared by them."""
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    return rank
+
+
+def _init_cpu_worker(counter, cores_per_job: int) -> None:
+    """Initializer of the forked CPU workers, which pins each worker to the
+    cores of its rank for its whole life."""
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO, force=True)
+    _set_cpu_affinity(_get_worker_rank(counter), cores_per_job)
+
+
+def _init_gpu_worker(counter, type_: str, use_bf16: bool, cores_per_job: int) -> None:
+    """Initializer of the spawned GPU workers. Each worker is bound to one GPU
+    for its whole life and builds its extractor there once, so the CUDA
+    context and the extractor are reused by all the splits it processes."""
+    global _WORKER_DEVICE
+    # Spawned workers do not run the __main__ block, set up their logging here.
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO, force=True)
+    rank = _get_worker_rank(counter)
+    _set_cpu_affinity(rank, cores_per_job)
+    _WORKER_DEVICE = f"cuda:{rank % torch.cuda.device_count()}"
+    torch.cuda.set_device(_WORKER_DEVICE)
+    _get_extractor(type_, _WORKER_DEVICE, use_bf16)
+
+
+# The cores we are allowed to run on, recorded before any pinning happens.
+_ALL_CORES = (
+    sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+)
+
+
+def _set_cpu_affinity(rank: int, cores_per_job: int) -> None:
+    """Pins the current process (and the DataLoader workers it will start) to
+    the core set of the worker `rank`, so that concurrent jobs don't thrash
+    each other's caches. Only supported on Linux, a no-op elsewhere."""
+    if _ALL_CORES is None:
+        return
+    cores = _ALL_CORES
+    num_slots = len(cores) // cores_per_job
+    if num_slots == 0:
+        return
+    slot = rank % num_slots
+    os.sched_setaffinity(0, cores[slot * cores_per_job : (slot + 1) * cores_per_job])
+
+
+def auto_batch_duration(
+    device: str,
+    num_jobs: int = 1,
+    jobs_per_device: int = 1,
+    num_workers: int = 0,
+    memory_fraction: float = 0.6,
+) -> int:
+    """Chooses the batch duration (in seconds) so that the batches of
+    `num_jobs` concurrent jobs fill about `memory_fraction` of the free host
+    memory, and, on GPU, the batches of the `jobs_per_device` jobs sharing
+    `device` fill about `memory_fraction` of its free memory.
+
+    Each job keeps `num_workers * _PREFETCH_FACTOR` batches queued in the
+    DataLoader, plus the batch being extracted and the one being saved."""
+    if psutil is not None:
+        free_host = psutil.virtual_memory().available
+    else:
+        free_host = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    config = VocosFbankConfig()
+    frames_per_sec = config.sampling_rate / config.hop_length
+    # the waveform, and its padded copy in the batch.
+    wave_bytes = 2 * config.sampling_rate * 4
+    # the mel spectrogram copied to CPU for saving.
+    feats_bytes = frames_per_sec * config.n_mels * 4
+    extract_bytes = (
+        wave_bytes
+        # the complex spectrogram and its magnitude.
+        + frames_per_sec * (config.n_fft // 2 + 1) * (8 + 4)
+        # the mel spectrogram and its log.
+        + frames_per_sec * config.n_mels * 4 * 2
+    )
+    num_batches = num_workers * _PREFETCH_FACTOR + 2
+    host_bytes = num_batches * (wave_bytes + feats_bytes)
+    if not device.startswith("cuda"):
+        host_bytes += extract_bytes
+    batch_duration = memory_fraction * free_host / num_jobs / host_bytes
+
+    if device.startswith("cuda"):
+        free_device = torch.cuda.mem_get_info(torch.device(device))[0]
+        batch_duration = min(
+            batch_duration,
+            memory_fraction * free_device / jobs_per_device / extract_bytes,
+        )
+    batch_duration = max(int(batch_duration), 1)
+    logging.info(f"Using batch duration {batch_duration}s on {device}")
+    return batch_duration
+
+
+def save_cuts(cut_set: CutSet, path: Path, num_threads: int = 4) -> None:
+    """Like cut_set.to_file(path), but compresses .jsonl.gz manifests with
+    pigz if it is installed, since the single-threaded gzip of Python takes
+    minutes for large manifests."""
+    pigz = shutil.which("pigz")
+    if pigz is None or not str(path).endswith(".jsonl.gz"):
+        cut_set.to_file(path)
+        return
+
+    # Write to a temporary file and move it in place only once pigz succeeded,
+    # so that a failed run never leaves a truncated manifest that later runs
+    # would take as done.
+    tmp_path = Path(f"{path}.tmp")
+    try:
+        with open(tmp_path, "wb") as f:
+            proc = subprocess.Popen(
+                [pigz, "-p", str(num_threads), "-c"], stdin=subprocess.PIPE, stdout=f
+            )
+            try:
+                with io.TextIOWrapper(proc.stdin, encoding="utf-8") as writer:
+                    for item in cut_set.to_dicts():
+                        print(json.dumps(item, ensure_ascii=False), file=writer)
+            finally:
+                returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f"pigz failed with code {returncode} on {path}")
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+def _source_key(source_paths: List[Path]) -> str:
+    """A short key that changes whenever one of the source manifests is
+    replaced or modified (path, size and modification time)."""
+    h = hashlib.sha1()
+    for path in source_paths:
+        stat = path.stat()
+        h.update(f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return h.hexdigest()[:16]
+
+
+def _save_float_audio(cut, audio_dir: Path):
+    """Like cut.save_audio(), but always stores float32 wav, so the resampled
+    samples are not quantized to 16 bits (as with flac) and the features match
+    the ones computed without the cache."""
+    path = audio_dir / cut.id[:3] / f"{cut.id}.wav"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    soundfile.write(path, cut.load_audio().T, cut.sampling_rate, subtype="FLOAT")
+    return fastcopy(
+        Recording.from_file(path, recording_id=cut.id).to_cut(),
+        id=cut.id,
+        supervisions=cut.supervisions,
+        custom=getattr(cut, "custom", None),
+    )
+
+
+def resample_cuts(
+    cut_set: CutSet, params, cuts_filename: str, source_paths: List[Path]
+) -> CutSet:
+    """Resamples the cuts to params.sampling_rate.
+
+    If params.resample_cache_dir is given, the resampled audio is saved there
+    as float32 wav files together with a manifest named `cuts_filename`
+    pointing to them, and later runs load that manifest instead of resampling
+    again. The cache entry is keyed by the sampling rate and by the source
+    manifests `source_paths`, so changing either of them resamples again.
+    """
+    if params.resample_cache_dir is None:
+        return cut_set.resample(params.sampling_rate)
+
+    cache_dir = (
+        Path(params.resample_cache_dir)
+        / f"{params.sampling_rate}hz"
+        / _source_key(source_paths)
+    )
+    cached_manifest = cache_dir / cuts_filename
+    if cached_manifest.is_file():
+        logging.info(f"Loading resampled cuts {cached_manifest}")
+        return load_manifest_lazy(cached_manifest)
+
+    audio_dir = cache_dir / cuts_filename.replace(".jsonl.gz", "")
+    audio_dir.mkdir(parents=True, exist_ok=True)
+    logging.info(f"Saving resampled audio to {audio_dir}")
+    # The cuts are streamed to the manifest one by one, which is moved in place
+    # last, so that an interrupted run is redone rather than reused.
+    tmp_manifest = cache_dir / f"tmp_{cuts_filename}"
+    with CutSet.open_writer(tmp_manifest, overwrite=True) as writer:
+        for cut in cut_set.resample(params.sampling_rate):
+            writer.write(_save_float_audio(cut, audio_dir))
+    os.replace(tmp_manifest, cached_manifest)
+    return load_manifest_lazy(cached_manifest)
+
+
+class _PrefetchedCuts:
+    """Iterates over the cuts of a lazy manifest in a background thread.
+
+    Reading a lazy manifest (gunzip and json parsing) happens in the sampler of
+    compute_and_store_features_batch, i.e. in the same thread that runs the
+    extractor. With this wrapper, the next cuts are read while the extractor
+    is busy with the current batch.
+    """
+
+    def __init__(self, cuts, buffer_size: int = 1000):
+        self.cuts = cuts
+        self.buffer_size = buffer_size
+
+    def __iter__(self):
+        buffer = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        end = object()
+
+        def _put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def _producer():
+            try:
+                for cut in self.cuts:
+                    if not _put(cut):
+                        return
+                _put(end)
+            except Exception as e:
+                _put(e)
+
+        thread = threading.Thread(target=_producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is end:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+
+def prefetch_cuts(cut_set: CutSet) -> CutSet:
+    """Returns the cut_set with the lazy manifest read in a background thread.
+    Eager cut sets are already in memory and returned as they are."""
+    if not cut_set.is_lazy:
+        return cut_set
+    return CutSet(_PrefetchedCuts(cut_set))
+
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -119,8 +446,48 @@ def get_args():
     parser.add_argument(
         "--batch-duration",
         type=int,
-        default=1000,
-        help="The batch duration when computing the features.",
+        default=None,
+        help="The batch duration (in seconds) when computing the features. "
+        "If not given, it is chosen from the free GPU or CPU memory.",
+    )
+
+    parser.add_argument(
+        "--resample-cache-dir",
+        type=str,
+        default=None,
+        help="If given, save the audio resampled to --sampling-rate in this "
+        "directory (as float32 wav, so it is not quantized) and reuse it in "
+        "later runs instead of resampling again. The cache is keyed by the "
+        "sampling rate and the source manifests.",
+    )
+
+    parser.add_argument(
+        "--audio-backend",
+        type=str,
+        default="default",
+        choices=lhotse.available_audio_backends(),
+        help="The lhotse audio backend used to read audio, e.g. LibsndfileBackend "
+        "to read every file with soundfile directly. The default backend tries "
+        "several libraries in turn and falls back to ffmpeg based ones.",
+    )
+
+    parser.add_argument(
+        "--use-bf16",
+        type=str2bool,
+        default=False,
+        help="Whether to compute the mel projection in bfloat16. It is faster "
+        "on GPUs with tensor cores and CPUs with AMX, but the features are "
+        "slightly less precise.",
+    )
+
+    parser.add_argument(
+        "--storage-type",
+        type=str,
+        default="lilcom_chunky",
+        choices=list(STORAGE_TYPES.keys()),
+        help="The storage format of the features. lilcom_chunky writes one "
+        "sequential file per split; lilcom_hdf5 writes one HDF5 file per split "
+        "with chunked datasets, which needs h5py.",
     )
 
     parser.add_argument(
@@ -133,7 +500,17 @@ def get_args():
     return parser.parse_args()
 
 
-def compute_fbank_split_single(params, idx):
+def compute_fbank_split_single(
+    params,
+    idx,
+    existing_src: Optional[FrozenSet[str]] = None,
+    existing_out: Optional[FrozenSet[str]] = None,
+):
+    """
+    existing_src and existing_out are the file names in the source and
+    destination directories, listed once by the caller. If they are None, the
+    file system is checked for this split directly.
+    """
     logging.info(
         f"Computing features for {idx}-th split of "
         f"{params.dataset} dataset {params.subset} subset"
@@ -142,18 +519,23 @@ def compute_fbank_split_single(params, idx):
     src_dir = Path(params.source_dir)
     output_dir = Path(params.dest_dir)
 
-    if not src_dir.exists():
-        logging.error(f"{src_dir} not exists")
-        return
+    if existing_src is None:
+        if not src_dir.exists():
+            logging.error(f"{src_dir} not exists")
+            return
 
-    if not output_dir.exists():
-        output_dir.mkdir(parents=True, exist_ok=True)
+        if not output_dir.exists():
+            output_dir.mkdir(parents=True, exist_ok=True)
 
     num_digits = 8
-    if params.type == "vocos":
-        extractor = VocosFbank()
+    # The STFT and the mel projection are much faster on GPU than on CPU.
+    # Workers of compute_fbank_split are bound to a GPU, otherwise the splits
+    # are distributed over the available GPUs in a round-robin way.
+    num_gpus = torch.cuda.device_count()
+    if _WORKER_DEVICE is not None:
+        device = _WORKER_DEVICE
     else:
-        raise NotImplementedError(f"{params.type} is not supported")
+        device = f"cuda:{idx % num_gpus}" if num_gpus > 0 else "cpu"
 
     prefix = params.dataset
     subset = params.subset
@@ -162,31 +544,66 @@ def compute_fbank_split_single(params, idx):
     idx = f"{idx}".zfill(num_digits)
     cuts_filename = f"{prefix}_cuts_{subset}.{idx}.{suffix}"
 
-    if (src_dir / cuts_filename).is_file():
+    # Check the output first, so that we don't decompress the manifest of
+    # splits that are already done.
+    if (
+        cuts_filename in existing_out
+        if existing_out is not None
+        else (output_dir / cuts_filename).is_file()
+    ):
+        logging.info(f"{cuts_filename} already exists - skipping.")
+        return
+
+    if (
+        cuts_filename in existing_src
+        if existing_src is not None
+        else (src_dir / cuts_filename).is_file()
+    ):
         logging.info(f"Loading manifests {src_dir / cuts_filename}")
         cut_set = load_manifest_lazy(src_dir / cuts_filename)
     else:
         logging.warning(f"Raw {cuts_filename} not exists, skipping")
         return
 
-    cut_set = cut_set.resample(params.sampling_rate)
-
-    if (output_dir / cuts_filename).is_file():
-        logging.info(f"{cuts_filename} already exists - skipping.")
-        return
-
-    logging.info(f"Processing {subset}.{idx} of {prefix}")
-
-    cut_set = cut_set.compute_and_store_features_batch(
+    cut_set = resample_cuts(
+        cut_set, params, cuts_filename, source_paths=[src_dir / cuts_filename]
+    )
+    extractor = _get_extractor(params.type, device, params.use_bf16)
+
+    logging.info(f"Processing {subset}.{idx} of {prefix} on {device}")
+
+    if num_gpus > 0:
+        # The extractor is cheap on GPU, so leave the DataLoader workers just
+        # for audio loading.
+        num_workers = _NUM_LOADER_WORKERS_GPU
+        if params.batch_duration is None:
+            batch_duration = auto_batch_duration(
+                device,
+                num_jobs=params.num_jobs,
+                jobs_per_device=math.ceil(params.num_jobs / num_gpus),
+                num_workers=num_workers,
+            )
+        else:
+            batch_duration = params.batch_duration
+    else:
+        num_workers = _NUM_LOADER_WORKERS_CPU
+        if params.batch_duration is None:
+            batch_duration = auto_batch_duration(
+                device, num_jobs=params.num_jobs, num_workers=num_workers
+            )
+        else:
+            batch_duration = params.batch_duration
+
+    cut_set = prefetch_cuts(cut_set).compute_and_store_features_batch(
         extractor=extractor,
         storage_path=f"{output_dir}/{prefix}_feats_{subset}_{idx}",
-        num_workers=4,
-        batch_duration=params.batch_duration,
-        storage_type=LilcomChunkyWriter,
+        num_workers=num_workers,
+        batch_duration=batch_duration,
+        storage_type=STORAGE_TYPES[params.storage_type],
         overwrite=True,
     )
     logging.info(f"Saving file to {output_dir / cuts_filename}")
-    cut_set.to_file(output_dir / cuts_filename)
+    save_cuts(cut_set, output_dir / cuts_filename)
 
 
 def compute_fbank_split(params):
@@ -196,14 +613,78 @@ def compute_fbank_split(params):
             f"{params.split_begin} -> {params.split_end}."
         )
 
-    with Pool(max_workers=params.num_jobs) as pool:
-        futures = [
-            pool.submit(compute_fbank_split_single, params, i)
-            for i in range(params.split_begin, params.split_end)
-        ]
-        for f in futures:
-            f.result()
-            f.done()
+    src_dir = Path(params.source_dir)
+    output_dir = Path(params.dest_dir)
+    if not src_dir.exists():
+        logging.error(f"{src_dir} not exists")
+        return
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # List both directories once here instead of stat-ing two files per split
+    # in the workers, which is slow on network file systems.
+    with os.scandir(src_dir) as it:
+        existing_src = frozenset(e.name for e in it)
+    with os.scandir(output_dir) as it:
+        existing_out = frozenset(e.name for e in it)
+
+    num_jobs = params.num_jobs
+    num_gpus = torch.cuda.device_count()
+    if num_gpus > 0:
+        # Two processes per GPU are enough to keep it busy, more processes
+        # only compete for GPU memory.
+        num_jobs = min(num_gpus * 2, num_jobs)
+        # CUDA can not be used in forked subprocesses. The spawned workers
+        # import torch again, so also limit the OpenMP/MKL thread pools there.
+        os.environ.setdefault("OMP_NUM_THREADS", "1")
+        os.environ.setdefault("MKL_NUM_THREADS", "1")
+        mp_context = multiprocessing.get_context("spawn")
+        initializer = _init_gpu_worker
+        initargs = (
+            mp_context.Value("i", 0),
+            params.type,
+            params.use_bf16,
+            _NUM_LOADER_WORKERS_GPU + 1,
+        )
+    else:
+        # Build the extractor before forking, the workers inherit it.
+        _get_extractor(params.type, "cpu", params.use_bf16)
+        mp_context = multiprocessing.get_context("fork")
+        initializer = _init_cpu_worker
+        initargs = (mp_context.Value("i", 0), _NUM_LOADER_WORKERS_CPU + 1)
+    num_jobs = max(1, min(num_jobs, params.split_end - params.split_begin))
+    logging.info(f"Using {num_jobs} jobs, {num_gpus} GPUs")
+    # The workers size their batches by the number of jobs actually running.
+    params.num_jobs = num_jobs
+
+    with Pool(
+        max_workers=num_jobs,
+        mp_context=mp_context,
+        initializer=initializer,
+        initargs=initargs,
+    ) as pool:
+        # Workers pick up the next split as soon as they are free. The results
+        # are handled in the order the splits finish, which re-raises any
+        # exception from the workers as soon as it happens.
+        futures = {
+            pool.submit(
+                compute_fbank_split_single,
+                params,
+                idx,
+                existing_src=existing_src,
+                existing_out=existing_out,
+            ): idx
+            for idx in range(params.split_begin, params.split_end)
+        }
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Splits", unit="split"
+        ):
+            try:
+                future.result()
+            except Exception:
+                logging.error(f"Failed to compute features of split {futures[future]}")
+                for f in futures:
+                    f.cancel()
+                raise
 
 
 def compute_fbank(params):
@@ -222,49 +703,68 @@ def compute_fbank(params):
 
     cut_set_name = f"{prefix}_cuts_{subset}.{suffix}"
 
+    if (output_dir / cut_set_name).is_file():
+        logging.info(f"{prefix} {subset} already exists - skipping.")
+        return
+
     if (src_dir / cut_set_name).is_file():
         logging.info(f"Loading manifests {src_dir / cut_set_name}")
+        source_paths = [src_dir / cut_set_name]
         cut_set = load_manifest_lazy(src_dir / cut_set_name)
     else:
-        recordings = load_manifest_lazy(
-            src_dir / f"{prefix}_recordings_{subset}.{suffix}"
-        )
-        supervisions = load_manifest_lazy(
-            src_dir / f"{prefix}_supervisions_{subset}.{suffix}"
-        )
+        source_paths = [
+            src_dir / f"{prefix}_recordings_{subset}.{suffix}",
+            src_dir / f"{prefix}_supervisions_{subset}.{suffix}",
+        ]
+        recordings = load_manifest_lazy(source_paths[0])
+        supervisions = load_manifest_lazy(source_paths[1])
         cut_set = CutSet.from_manifests(
             recordings=recordings,
             supervisions=supervisions,
         )
 
-    cut_set = cut_set.resample(params.sampling_rate)
-    if params.type == "vocos":
-        extractor = VocosFbank()
-    else:
-        raise NotImplementedError(f"{params.type} is not supported")
-
-    cuts_filename = f"{prefix}_cuts_{subset}.{suffix}"
-    if (output_dir / cuts_filename).is_file():
-        logging.info(f"{prefix} {subset} already exists - skipping.")
-        return
-    logging.info(f"Processing {subset} of {prefix}")
-
-    cut_set = cut_set.compute_and_store_features(
+    cut_set = resample_cuts(cut_set, params, cut_set_name, source_paths)
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    extractor = _get_extractor(params.type, device, params.use_bf16)
+
+    logging.info(f"Processing {subset} of {prefix} on {device}")
+
+    num_workers = min(num_jobs, 8)
+    if device == "cpu":
+        # Only this process runs the extractor, so let the batched STFT and
+        # mel matmul use the cores that are not taken by the loading workers.
+        # (torch.set_num_threads(1) above is meant for the worker processes.)
+        num_cores = len(_ALL_CORES) if _ALL_CORES is not None else os.cpu_count()
+        num_threads = max(1, num_cores - num_workers)
+        torch.set_num_threads(num_threads)
+        logging.info(f"Using {num_threads} threads for feature extraction")
+
+    # The batched version packs many cuts into one STFT/matmul call; the
+    # DataLoader workers inside it take care of the parallel audio loading.
+    cut_set = prefetch_cuts(cut_set).compute_and_store_features_batch(
         extractor=extractor,
         storage_path=f"{output_dir}/{prefix}_feats_{subset}",
-        num_jobs=num_jobs,
-        storage_type=LilcomChunkyWriter,
+        num_workers=num_workers,
+        batch_duration=(
+            params.batch_duration
+            if params.batch_duration is not None
+            else auto_batch_duration(device, num_workers=num_workers)
+        ),
+        storage_type=STORAGE_TYPES[params.storage_type],
+        overwrite=True,
     )
-    logging.info(f"Saving file to {output_dir / cuts_filename}")
-    cut_set.to_file(output_dir / cuts_filename)
+    logging.info(f"Saving file to {output_dir / cut_set_name}")
+    save_cuts(cut_set, output_dir / cut_set_name)
 
 
 if __name__ == "__main__":
-    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
-    logging.basicConfig(format=formatter, level=logging.INFO, force=True)
+    logging.basicConfig(format=_LOG_FORMAT, level=logging.INFO, force=True)
 
     args = get_args()
     logging.info(vars(args))
+    if args.audio_backend != "default":
+        # lhotse reads this variable in every process, including the workers.
+        os.environ["LHOTSE_AUDIO_BACKEND"] = args.audio_backend
     if args.split_cuts:
         compute_fbank_split(params=args)
     else:
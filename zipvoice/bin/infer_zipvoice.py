@@ -76,6 +76,7 @@ from zipvoice.tokenizer.tokenizer import (
 from zipvoice.utils.checkpoint import load_checkpoint
 from zipvoice.utils.common import AttributeDict
 from zipvoice.utils.feature import VocosFbank
+from zipvoice.utils.scaling_converter import convert_scaled_to_non_scaled
 
 HUGGINGFACE_REPO = "k2-fsa/ZipVoice"
 MODEL_DIR = {
@@ -236,6 +237,36 @@ def get_parser():
         help="Random seed",
     )
 
+    parser.add_argument(
+        "--compile-mode",
+        type=str,
+        default="none",
+        choices=["none", "default", "reduce-overhead"],
+        help="Compile the flow-matching decoder with torch.compile. "
+        "'default' fuses the ops of each encoder layer and works with any input "
+        "length. 'reduce-overhead' additionally captures the whole decoder in "
+        "CUDA graphs, which removes most kernel launch overhead of the "
+        "num_step decoder calls, but compiles a new graph for every distinct "
+        "number of frames. After torch._dynamo's recompile limit (8 by "
+        "default) is reached, the decoder silently runs eagerly again, so it "
+        "only pays off when few distinct lengths are generated (e.g. a single "
+        "sentence, or inputs of fixed length). A test set with varied prompt "
+        "and text lengths hits the limit almost immediately.",
+    )
+
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="float32",
+        choices=["float32", "bfloat16", "float16", "int8"],
+        help="The precision of the flow-matching decoder. 'bfloat16' and "
+        "'float16' run it under torch.autocast, which uses the tensor cores of "
+        "recent GPUs. 'float16' is only supported on CUDA and 'bfloat16' on "
+        "CUDA and CPU. 'int8' applies dynamic int8 quantization to its linear "
+        "layers and is only supported on CPU. The lower precisions are faster "
+        "but may slightly change the generated speech.",
+    )
+
     return parser
 
 
@@ -347,6 +378,9 @@ def generate_sentence(
         guidance_scale=guidance_scale,
     )
 
+    # The number of frames the decoder ran on, prompt included.
+    num_frames = pred_features.size(1) + pred_prompt_features.size(1)
+
     # Postprocess predicted features
     pred_features = pred_features.permute(0, 2, 1) / feat_scale  # (B, C, T)
 
@@ -370,6 +404,7 @@ def generate_sentence(
         "rtf": rtf,
         "rtf_no_vocoder": rtf_no_vocoder,
         "rtf_vocoder": rtf_vocoder,
+        "num_frames": num_frames,
     }
 
     # Adjust wav volume if necessary
@@ -395,8 +430,17 @@ def generate_list(
     target_rms: float = 0.1,
     feat_scale: float = 0.1,
     sampling_rate: int = 24000,
+    recompile_limit: Optional[int] = None,
 ):
+    """Generates the sentences of `test_list`, see generate_sentence().
+
+    If `recompile_limit` is given (the decoder is compiled for static shapes),
+    a warning is logged once more distinct lengths than that have been
+    generated, since torch._dynamo then falls back to running the decoder
+    eagerly.
+    """
     total_t = []
+    seen_num_frames = set()
     total_t_no_vocoder = []
     total_t_vocoder = []
     total_wav_seconds = []
@@ -426,6 +470,16 @@ def generate_list(
             sampling_rate=sampling_rate,
         )
         logging.info(f"[Sentence: {i}] RTF: {metrics['rtf']:.4f}")
+        if recompile_limit is not None and len(seen_num_frames) <= recompile_limit:
+            seen_num_frames.add(metrics["num_frames"])
+            if len(seen_num_frames) > recompile_limit:
+                logging.warning(
+                    f"The decoder has seen more than {recompile_limit} distinct "
+                    "input lengths, torch._dynamo falls back to running it "
+                    "eagerly from now on. --compile-mode reduce-overhead gives no "
+                    "speedup for inputs of varied length, use --compile-mode "
+                    "default instead."
+                )
         total_t.append(metrics["t"])
         total_t_no_vocoder.append(metrics["t_no_vocoder"])
         total_t_vocoder.append(metrics["t_vocoder"])
@@ -550,6 +604,54 @@ def main():
 
     model = model.to(params.device)
     model.eval()
+    # Balancer, Whiten and Dropout3 only act in training; replacing them with
+    # nn.Identity saves their per-call Python overhead in every layer.
+    convert_scaled_to_non_scaled(model, inplace=True)
+
+    if params.precision == "float16":
+        assert params.device.type == "cuda", (
+            "--precision float16 is only supported on CUDA, "
+            f"but the device is {params.device}"
+        )
+    elif params.precision == "bfloat16":
+        assert params.device.type in ("cuda", "cpu"), (
+            "--precision bfloat16 is only supported on CUDA and CPU, "
+            f"but the device is {params.device}"
+        )
+    if params.precision in ("bfloat16", "float16"):
+        model.fm_decoder.enable_autocast(getattr(torch, params.precision))
+    elif params.precision == "int8":
+        assert params.device.type == "cpu", (
+            "--precision int8 is only supported on CPU, "
+            f"but the device is {params.device}"
+        )
+        # Split the fused activation + linear modules, so that their linear
+        # layers are quantized too.
+        convert_scaled_to_non_scaled(
+            model.fm_decoder, inplace=True, split_activation_linear=True
+        )
+        model.fm_decoder = torch.ao.quantization.quantize_dynamic(
+            model.fm_decoder, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    recompile_limit = None
+    if params.compile_mode == "default":
+        model.fm_decoder.enable_compile()
+    elif params.compile_mode == "reduce-overhead":
+        # The decoder is called num_step times with the same shapes for each
+        # sentence, but each new length is compiled and captured again.
+        model.fm_decoder.compile(mode="reduce-overhead", dynamic=False)
+        dynamo_config = torch._dynamo.config
+        recompile_limit = getattr(
+            dynamo_config,
+            "recompile_limit",
+            getattr(dynamo_config, "cache_size_limit", 8),
+        )
+        logging.warning(
+            "--compile-mode reduce-overhead compiles the decoder for each "
+            f"distinct input length; after {recompile_limit} lengths it runs "
+            "eagerly again without any speedup."
+        )
 
     vocoder = get_vocoder(params.vocoder_path)
     vocoder = vocoder.to(params.device)
@@ -581,6 +683,7 @@ def main():
             target_rms=params.target_rms,
             feat_scale=params.feat_scale,
             sampling_rate=params.sampling_rate,
+            recompile_limit=recompile_limit,
         )
     else:
         generate_sentence(
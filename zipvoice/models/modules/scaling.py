@@ -204,6 +204,9 @@ class ScheduledFloat(torch.nn.Module):
         self.name = None
         self.default = default
         self.schedule = PiecewiseLinear(*args)
+        # (batch_count, value) of the last evaluation; the value only changes
+        # once per batch but is read by every forward of every layer.
+        self._cached_value = (None, None)
 
     def extra_repr(self) -> str:
         return (
@@ -220,7 +223,10 @@ class ScheduledFloat(torch.nn.Module):
         ):
             return float(self.default)
         else:
-            ans = self.schedule(self.batch_count)
+            cached_batch_count, ans = self._cached_value
+            if cached_batch_count != batch_count:
+                ans = self.schedule(batch_count)
+                self._cached_value = (batch_count, ans)
             if random.random() < 0.0002:
                 logging.debug(
                     f"ScheduledFloat: name={self.name}, "
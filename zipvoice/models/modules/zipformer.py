@@ -18,11 +18,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import copy
 import logging
 import math
 import random
-from typing import Optional, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 from torch import Tensor, nn
@@ -44,31 +45,110 @@ from zipvoice.models.modules.scaling import (
 )
 
 
-def timestep_embedding(timesteps, dim, max_period=10000):
+def _is_compiling() -> bool:
+    """True if the code is being traced by torch.compile (dynamo)."""
+    compiler = getattr(torch, "compiler", None)
+    if compiler is not None and hasattr(compiler, "is_compiling"):
+        return compiler.is_compiling()
+    return False
+
+
+def timestep_freqs(dim, max_period=10000):
+    """The frequencies of the sinusoidal timestep embeddings, of shape (dim // 2,)."""
+    half = dim // 2
+    return torch.exp(
+        -math.log(max_period)
+        * torch.arange(start=0, end=half, dtype=torch.float32)
+        / half
+    )
+
+
+def timestep_embedding(timesteps, dim, max_period=10000, freqs=None):
     """Create sinusoidal timestep embeddings.
 
     :param timesteps: shape of (N) or (N, T)
     :param dim: the dimension of the output.
     :param max_period: controls the minimum frequency of the embeddings.
+    :param freqs: the output of timestep_freqs(dim, max_period) on the device of
+        timesteps, computed here in float32 if None or not float32 (e.g. a
+        buffer cast by model.half()).
     :return: an Tensor of positional embeddings. shape of (N, dim) or (T, N, dim)
     """
-    half = dim // 2
-    freqs = torch.exp(
-        -math.log(max_period)
-        * torch.arange(start=0, end=half, dtype=torch.float32, device=timesteps.device)
-        / half
-    )
+    if freqs is None or freqs.dtype != torch.float32:
+        half = dim // 2
+        freqs = torch.exp(
+            -math.log(max_period)
+            * torch.arange(
+                start=0, end=half, dtype=torch.float32, device=timesteps.device
+            )
+            / half
+        )
 
     if timesteps.dim() == 2:
         timesteps = timesteps.transpose(0, 1)  # (N, T) -> (T, N)
 
     args = timesteps[..., None].float() * freqs[None]
-    embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
+    if (
+        args.requires_grad
+        or torch.jit.is_scripting()
+        or torch.jit.is_tracing()
+        or _is_compiling()
+    ):
+        embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
+        if dim % 2:
+            embedding = torch.cat(
+                [embedding, torch.zeros_like(embedding[..., :1])], dim=-1
+            )
+        return embedding
+
+    # Write cos and sin directly into the two halves of the output, instead of
+    # allocating them separately and concatenating.
+    half = args.shape[-1]
+    embedding = args.new_empty(args.shape[:-1] + (dim,))
+    torch.cos(args, out=embedding[..., :half])
+    torch.sin(args, out=embedding[..., half : 2 * half])
     if dim % 2:
-        embedding = torch.cat([embedding, torch.zeros_like(embedding[..., :1])], dim=-1)
+        embedding[..., -1] = 0.0
     return embedding
 
 
+_compiled_timestep_embedding = None
+
+
+def compiled_timestep_embedding(timesteps, dim, max_period=10000, freqs=None):
+    """timestep_embedding() compiled with torch.compile, so that the frequencies,
+    the outer product, cos/sin and the concatenation are fused into one kernel
+    instead of five. It is compiled on the first call.
+    """
+    global _compiled_timestep_embedding
+    if _compiled_timestep_embedding is None:
+        _compiled_timestep_embedding = torch.compile(
+            timestep_embedding, fullgraph=True, dynamic=True
+        )
+    return _compiled_timestep_embedding(timesteps, dim, max_period, freqs)
+
+
+def _use_compile(module: nn.Module) -> bool:
+    return (
+        module.use_compile
+        and not torch.jit.is_scripting()
+        and not torch.jit.is_tracing()
+    )
+
+
+def _autocast_context(module: nn.Module, x: Tensor):
+    """The autocast context of the forward pass of `module` at inference,
+    see TTSZipformer.enable_autocast()."""
+    if (
+        module.autocast_dtype is None
+        or module.training
+        or torch.jit.is_scripting()
+        or torch.jit.is_tracing()
+    ):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=x.device.type, dtype=module.autocast_dtype)
+
+
 class TTSZipformer(nn.Module):
     """
     Args:
@@ -175,6 +255,24 @@ class TTSZipformer(nn.Module):
         else:
             time_embed_dim = -1
         self.guidance_scale_embed_dim = guidance_scale_embed_dim
+        # see enable_compile() and enable_autocast()
+        self.use_compile = False
+        self.autocast_dtype = None
+
+        # The frequencies of timestep_embedding(), computed once here instead of
+        # in every forward call. Not saved in the state dict. If the model is
+        # cast to float16/bfloat16, timestep_embedding() computes them in
+        # float32 again instead.
+        if self.use_time_embed:
+            self.register_buffer(
+                "time_freqs", timestep_freqs(time_embed_dim), persistent=False
+            )
+        if self.use_guidance_scale_embed:
+            self.register_buffer(
+                "guidance_freqs",
+                timestep_freqs(guidance_scale_embed_dim),
+                persistent=False,
+            )
 
         self.in_proj = nn.Linear(in_dim, encoder_dim)
         self.out_proj = nn.Linear(encoder_dim, out_dim)
@@ -239,6 +337,36 @@ class TTSZipformer(nn.Module):
         else:
             self.guidance_scale_embed = None
 
+    def enable_compile(self, enabled: bool = True, dynamic: bool = True) -> None:
+        """Runs the hot parts of the forward pass through torch.compile, which
+        fuses their small elementwise ops into fewer kernels. Meant for
+        inference on GPU; the first calls are slow because of the compilation.
+        It has no effect when the model is traced or scripted (e.g. for ONNX
+        export).
+
+        With dynamic=False, the encoder layers are compiled for the exact
+        shapes they are called with, which gives fewer guards and better
+        kernels when the input shapes are fixed (e.g. a server with padded
+        batches), but compiles again for each new shape.
+        """
+        for module in self.modules():
+            if hasattr(module, "use_compile"):
+                module.use_compile = enabled
+            if hasattr(module, "compile_dynamic"):
+                module.compile_dynamic = dynamic
+                module._compiled_forward = None
+
+    def enable_autocast(self, dtype: Optional[torch.dtype] = torch.bfloat16) -> None:
+        """Runs the forward pass under torch.autocast with the given dtype (e.g.
+        torch.bfloat16 or torch.float16) at inference, which roughly halves the
+        memory traffic of the linear, convolution and attention ops and uses
+        the tensor cores of recent GPUs. Normalizations and softmax still run in
+        float32 and the output is cast back to the dtype of the input. Pass None
+        to disable it. It has no effect in training mode, which uses its own
+        autocast, or when the model is traced or scripted.
+        """
+        self.autocast_dtype = dtype
+
     def forward(
         self,
         x: Tensor,
@@ -261,35 +389,67 @@ class TTSZipformer(nn.Module):
           Return the output embeddings. its shape is
             (batch_size, output_seq_len, encoder_dim)
         """
-        x = x.permute(1, 0, 2)
-        x = self.in_proj(x)
-
-        if t is not None:
-            assert t.dim() == 1 or t.dim() == 2, t.shape
-            time_emb = timestep_embedding(t, self.time_embed_dim)
-            if guidance_scale is not None:
-                assert (
-                    guidance_scale.dim() == 1 or guidance_scale.dim() == 2
-                ), guidance_scale.shape
-                guidance_scale_emb = self.guidance_scale_embed(
-                    timestep_embedding(guidance_scale, self.guidance_scale_embed_dim)
+        in_dtype = x.dtype
+        with _autocast_context(self, x):
+            # Project in the (batch, time, channel) layout of the input, so that
+            # the matmul reads it contiguously, and only then switch to (time,
+            # batch, channel), which is a view.
+            x = self.in_proj(x).permute(1, 0, 2)
+
+            if t is not None:
+                assert t.dim() == 1 or t.dim() == 2, t.shape
+                embed_fn = (
+                    compiled_timestep_embedding
+                    if _use_compile(self)
+                    else timestep_embedding
                 )
-                time_emb = time_emb + guidance_scale_emb
-            time_emb = self.time_embed(time_emb)
-        else:
-            time_emb = None
+                if guidance_scale is not None:
+                    assert (
+                        guidance_scale.dim() == 1 or guidance_scale.dim() == 2
+                    ), guidance_scale.shape
+                if (
+                    guidance_scale is not None
+                    and self.guidance_scale_embed_dim == self.time_embed_dim
+                    and guidance_scale.shape == t.shape
+                ):
+                    # Embed t and guidance_scale in one call by concatenating
+                    # them along the batch axis, which is axis 1 of the
+                    # (seq_len, batch_size, dim) output of 2-D inputs.
+                    batch_dim = 0 if t.dim() == 1 else 1
+                    time_emb, guidance_scale_emb = embed_fn(
+                        torch.cat([t.float(), guidance_scale.float()], dim=0),
+                        self.time_embed_dim,
+                        freqs=self.time_freqs,
+                    ).chunk(2, dim=batch_dim)
+                    time_emb = time_emb + self.guidance_scale_embed(guidance_scale_emb)
+                else:
+                    time_emb = embed_fn(t, self.time_embed_dim, freqs=self.time_freqs)
+                    if guidance_scale is not None:
+                        guidance_scale_emb = self.guidance_scale_embed(
+                            embed_fn(
+                                guidance_scale,
+                                self.guidance_scale_embed_dim,
+                                freqs=self.guidance_freqs,
+                            )
+                        )
+                        time_emb = time_emb + guidance_scale_emb
+                time_emb = self.time_embed(time_emb)
+            else:
+                time_emb = None
 
-        attn_mask = None
+            attn_mask = None
 
-        for i, module in enumerate(self.encoders):
-            x = module(
-                x,
-                time_emb=time_emb,
-                src_key_padding_mask=padding_mask,
-                attn_mask=attn_mask,
-            )
-        x = self.out_proj(x)
-        x = x.permute(1, 0, 2)
+            for module in self.encoders:
+                x = module(
+                    x,
+                    time_emb=time_emb,
+                    src_key_padding_mask=padding_mask,
+                    attn_mask=attn_mask,
+                )
+            x = self.out_proj(x)
+            x = x.permute(1, 0, 2)
+        if x.dtype != in_dtype:
+            x = x.to(in_dtype)
         return x
 
 
@@ -396,6 +556,11 @@ class Zipformer2EncoderLayer(nn.Module):
 
         self.use_conv = use_conv
 
+        # see TTSZipformer.enable_compile()
+        self.use_compile = False
+        self.compile_dynamic = True
+        self._compiled_forward = None
+
         if self.use_conv:
             self.conv_module1 = ConvolutionModule(embed_dim, cnn_module_kernel)
 
@@ -461,30 +626,41 @@ class Zipformer2EncoderLayer(nn.Module):
             max_abs=4.0,
         )
 
-    def get_sequence_dropout_mask(
-        self, x: Tensor, dropout_rate: float
-    ) -> Optional[Tensor]:
+    def get_sequence_dropout_masks(
+        self, x: Tensor, dropout_rates: List[float]
+    ) -> List[Optional[Tensor]]:
+        """
+        Returns one sequence-level dropout mask of shape (batch_size, 1) per
+        dropout rate, or None for rates that are 0 (and at inference). The random
+        numbers of all the masks are drawn by a single torch.rand call.
+        x shape: (seq_len, batch_size, embed_dim)
+        """
         if (
-            dropout_rate == 0.0
-            or not self.training
+            not self.training
             or torch.jit.is_scripting()
             or torch.jit.is_tracing()
+            or all(rate == 0.0 for rate in dropout_rates)
         ):
-            return None
+            return [None] * len(dropout_rates)
         batch_size = x.shape[1]
-        mask = (torch.rand(batch_size, 1, device=x.device) > dropout_rate).to(x.dtype)
-        return mask
+        rand = torch.rand(batch_size, len(dropout_rates), device=x.device)
+        return [
+            None if rate == 0.0 else (rand[:, i : i + 1] > rate).to(x.dtype)
+            for i, rate in enumerate(dropout_rates)
+        ]
 
-    def sequence_dropout(self, x: Tensor, dropout_rate: float) -> Tensor:
+    def add_with_dropout_mask(
+        self, src: Tensor, x: Tensor, dropout_mask: Optional[Tensor]
+    ) -> Tensor:
         """
-        Apply sequence-level dropout to x.
-        x shape: (seq_len, batch_size, embed_dim)
+        Returns src + x * dropout_mask (or src + x if dropout_mask is None).
+        The multiplication and the addition are done by a single torch.addcmul,
+        so x * dropout_mask is never materialized.
         """
-        dropout_mask = self.get_sequence_dropout_mask(x, dropout_rate)
         if dropout_mask is None:
-            return x
+            return src + x
         else:
-            return x * dropout_mask
+            return torch.addcmul(src, x, dropout_mask)
 
     def forward(
         self,
@@ -512,17 +688,64 @@ class Zipformer2EncoderLayer(nn.Module):
         Returns:
            A tensor which has the same shape as src
         """
+        if _use_compile(self) and not self.training:
+            # The whole layer is compiled as one graph at inference, so that
+            # the chains of elementwise ops (e.g. balancer1, norm, bypass,
+            # balancer2 and whiten at the end) are fused. In training, the
+            # custom autograd functions of the balancers would break the graph.
+            if self._compiled_forward is None:
+                self._compiled_forward = torch.compile(
+                    self._forward, dynamic=self.compile_dynamic
+                )
+            return self._compiled_forward(
+                src, pos_emb, time_emb, attn_mask, src_key_padding_mask
+            )
+        return self._forward(src, pos_emb, time_emb, attn_mask, src_key_padding_mask)
+
+    def _forward(
+        self,
+        src: Tensor,
+        pos_emb: Tensor,
+        time_emb: Optional[Tensor],
+        attn_mask: Optional[Tensor],
+        src_key_padding_mask: Optional[Tensor],
+    ) -> Tensor:
         src_orig = src
 
-        # dropout rate for non-feedforward submodules
-        if torch.jit.is_scripting() or torch.jit.is_tracing():
+        if torch.jit.is_scripting() or torch.jit.is_tracing() or not self.training:
             attention_skip_rate = 0.0
+            conv_skip_rate = 0.0
+            ff2_skip_rate = 0.0
+            ff3_skip_rate = 0.0
         else:
-            attention_skip_rate = (
-                float(self.attention_skip_rate) if self.training else 0.0
-            )
+            # dropout rate for non-feedforward submodules
+            attention_skip_rate = float(self.attention_skip_rate)
+            conv_skip_rate = float(self.conv_skip_rate) if self.use_conv else 0.0
+            ff2_skip_rate = float(self.ff2_skip_rate)
+            ff3_skip_rate = float(self.ff3_skip_rate)
+        (
+            self_attn_dropout_mask,
+            conv1_dropout_mask,
+            ff2_dropout_mask,
+            conv2_dropout_mask,
+            ff3_dropout_mask,
+        ) = self.get_sequence_dropout_masks(
+            src,
+            [
+                attention_skip_rate,
+                conv_skip_rate,
+                ff2_skip_rate,
+                conv_skip_rate,
+                ff3_skip_rate,
+            ],
+        )
 
         # attn_weights: (num_heads, batch_size, seq_len, seq_len)
+        # They are computed once and shared by nonlin_attention, self_attn1 and
+        # self_attn2, whose inputs depend on each other's outputs. A fused
+        # attention kernel (e.g. scaled_dot_product_attention) would have to
+        # recompute softmax(QK^T + pos_scores) for each of them, which costs
+        # more than the three (seq_len x seq_len) @ (seq_len x head_dim) matmuls.
         attn_weights = self.self_attn_weights(
             src,
             pos_emb=pos_emb,
@@ -535,10 +758,6 @@ class Zipformer2EncoderLayer(nn.Module):
 
         src = src + self.feed_forward1(src)
 
-        self_attn_dropout_mask = self.get_sequence_dropout_mask(
-            src, attention_skip_rate
-        )
-
         selected_attn_weights = attn_weights[0:1]
         if torch.jit.is_scripting() or torch.jit.is_tracing():
             pass
@@ -557,41 +776,29 @@ class Zipformer2EncoderLayer(nn.Module):
 
         na = self.balancer_na(self.nonlin_attention(src, selected_attn_weights))
 
-        src = src + (
-            na if self_attn_dropout_mask is None else na * self_attn_dropout_mask
-        )
+        src = self.add_with_dropout_mask(src, na, self_attn_dropout_mask)
 
         self_attn = self.self_attn1(src, attn_weights)
 
-        src = src + (
-            self_attn
-            if self_attn_dropout_mask is None
-            else self_attn * self_attn_dropout_mask
-        )
+        src = self.add_with_dropout_mask(src, self_attn, self_attn_dropout_mask)
 
         if self.use_conv:
-            if torch.jit.is_scripting() or torch.jit.is_tracing():
-                conv_skip_rate = 0.0
-            else:
-                conv_skip_rate = float(self.conv_skip_rate) if self.training else 0.0
-
             if time_emb is not None:
-                src = src + time_emb
+                # src is a fresh result of the residual add above and is not
+                # saved by any op for backward, so it can be updated in place.
+                src.add_(time_emb)
 
-            src = src + self.sequence_dropout(
+            src = self.add_with_dropout_mask(
+                src,
                 self.conv_module1(
                     src,
                     src_key_padding_mask=src_key_padding_mask,
                 ),
-                conv_skip_rate,
+                conv1_dropout_mask,
             )
 
-        if torch.jit.is_scripting() or torch.jit.is_tracing():
-            ff2_skip_rate = 0.0
-        else:
-            ff2_skip_rate = float(self.ff2_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(
-            self.balancer_ff2(self.feed_forward2(src)), ff2_skip_rate
+        src = self.add_with_dropout_mask(
+            src, self.balancer_ff2(self.feed_forward2(src)), ff2_dropout_mask
         )
 
         # bypass in the middle of the layer.
@@ -599,36 +806,24 @@ class Zipformer2EncoderLayer(nn.Module):
 
         self_attn = self.self_attn2(src, attn_weights)
 
-        src = src + (
-            self_attn
-            if self_attn_dropout_mask is None
-            else self_attn * self_attn_dropout_mask
-        )
+        src = self.add_with_dropout_mask(src, self_attn, self_attn_dropout_mask)
 
         if self.use_conv:
 
-            if torch.jit.is_scripting() or torch.jit.is_tracing():
-                conv_skip_rate = 0.0
-            else:
-                conv_skip_rate = float(self.conv_skip_rate) if self.training else 0.0
-
             if time_emb is not None:
-                src = src + time_emb
+                src.add_(time_emb)
 
-            src = src + self.sequence_dropout(
+            src = self.add_with_dropout_mask(
+                src,
                 self.conv_module2(
                     src,
                     src_key_padding_mask=src_key_padding_mask,
                 ),
-                conv_skip_rate,
+                conv2_dropout_mask,
             )
 
-        if torch.jit.is_scripting() or torch.jit.is_tracing():
-            ff3_skip_rate = 0.0
-        else:
-            ff3_skip_rate = float(self.ff3_skip_rate) if self.training else 0.0
-        src = src + self.sequence_dropout(
-            self.balancer_ff3(self.feed_forward3(src)), ff3_skip_rate
+        src = self.add_with_dropout_mask(
+            src, self.balancer_ff3(self.feed_forward3(src)), ff3_dropout_mask
         )
 
         src = self.balancer1(src)
@@ -732,7 +927,7 @@ class Zipformer2Encoder(nn.Module):
 
         output = src
 
-        for i, mod in enumerate(self.layers):
+        for mod in self.layers:
             output = mod(
                 output,
                 pos_emb,
@@ -775,25 +970,28 @@ class BypassModule(nn.Module):
         if torch.jit.is_scripting() or torch.jit.is_tracing() or not self.training:
             return self.bypass_scale
         else:
-            ans = limit_param_value(
-                self.bypass_scale,
-                min=float(self.scale_min),
-                max=float(self.scale_max),
-            )
-            skip_rate = float(self.skip_rate)
-            if skip_rate != 0.0:
-                mask = torch.rand((batch_size, 1), device=ans.device) > skip_rate
-                ans = ans * mask
-                # now ans is of shape (batch_size, num_channels), and is zero for
-                # sequences on which we have randomly chosen to do layer-skipping.
-            straight_through_rate = float(self.straight_through_rate)
-            if straight_through_rate != 0.0:
-                mask = (
-                    torch.rand((batch_size, 1), device=ans.device)
-                    < straight_through_rate
-                )
-                ans = torch.maximum(ans, mask.to(ans.dtype))
+            return self._get_training_bypass_scale(batch_size)
+
+    def _get_training_bypass_scale(self, batch_size: int) -> Tensor:
+        ans = limit_param_value(
+            self.bypass_scale,
+            min=float(self.scale_min),
+            max=float(self.scale_max),
+        )
+        skip_rate = float(self.skip_rate)
+        straight_through_rate = float(self.straight_through_rate)
+        if skip_rate == 0.0 and straight_through_rate == 0.0:
             return ans
+        # the random numbers of both masks, drawn at once.
+        rand = torch.rand((batch_size, 2), device=ans.device)
+        if skip_rate != 0.0:
+            ans = ans * (rand[:, 0:1] > skip_rate)
+            # now ans is of shape (batch_size, num_channels), and is zero for
+            # sequences on which we have randomly chosen to do layer-skipping.
+        if straight_through_rate != 0.0:
+            mask = rand[:, 1:2] < straight_through_rate
+            ans = torch.maximum(ans, mask.to(ans.dtype))
+        return ans
 
     def forward(self, src_orig: Tensor, src: Tensor):
         """
@@ -801,7 +999,9 @@ class BypassModule(nn.Module):
         Returns: something with the same shape as src and src_orig
         """
         bypass_scale = self._get_bypass_scale(src.shape[1])
-        return src_orig + (src - src_orig) * bypass_scale
+        # src_orig + (src - src_orig) * bypass_scale, with the multiplication and
+        # the addition in one kernel.
+        return torch.addcmul(src_orig, src - src_orig, bypass_scale)
 
 
 class DownsampledZipformer2Encoder(nn.Module):
@@ -897,20 +1097,23 @@ class SimpleDownsample(torch.nn.Module):
         # Pad to an exact multiple of self.downsample
         # right-pad src, repeating the last element.
         pad = d_seq_len * ds - seq_len
-        src_extra = src[src.shape[0] - 1 :].expand(pad, src.shape[1], src.shape[2])
-        src = torch.cat((src, src_extra), dim=0)
+        # When tracing, the padding is always added, so that the traced graph
+        # works for any seq_len.
+        if pad > 0 or torch.jit.is_tracing():
+            src_extra = src[src.shape[0] - 1 :].expand(pad, src.shape[1], src.shape[2])
+            src = torch.cat((src, src_extra), dim=0)
         assert src.shape[0] == d_seq_len * ds
 
-        src = src.reshape(d_seq_len, ds, batch_size, in_channels)
+        src = src.reshape(d_seq_len, ds, batch_size * in_channels)
 
         weights = self.bias.softmax(dim=0)
-        # weights: (downsample, 1, 1)
-        weights = weights.unsqueeze(-1).unsqueeze(-1)
+        # weights: (downsample,)
 
-        # ans1 is the first `in_channels` channels of the output
-        ans = (src * weights).sum(dim=1)
+        # The weighted sum over the downsample axis, as one batched
+        # vector-matrix product instead of a broadcast multiply and a sum.
+        ans = torch.matmul(weights, src)
 
-        return ans
+        return ans.view(d_seq_len, batch_size, in_channels)
 
 
 class SimpleUpsample(torch.nn.Module):
@@ -990,6 +1193,10 @@ class CompactRelPositionalEncoding(torch.nn.Module):
             if self.pe.size(0) >= T * 2 - 1:
                 self.pe = self.pe.to(dtype=x.dtype, device=x.device)
                 return
+            # Grow the table at least geometrically, so that inputs of slowly
+            # increasing lengths do not rebuild it on every call.  The encoding
+            # of each relative position does not depend on T.
+            T = max(T, self.pe.size(0) + 1)
 
         # if T == 4, x would contain [ -3, -2, 1, 0, 1, 2, 3 ]
         x = torch.arange(-(T - 1), T, device=x.device).to(torch.float32).unsqueeze(1)
@@ -1024,7 +1231,8 @@ class CompactRelPositionalEncoding(torch.nn.Module):
         cosines = (x_atan * freqs).cos()
         sines = (x_atan * freqs).sin()
 
-        pe = torch.zeros(x.shape[0], self.embed_dim, device=x.device)
+        # every column is written below, as embed_dim is even.
+        pe = torch.empty(x.shape[0], self.embed_dim, device=x.device)
         pe[:, 0::2] = cosines
         pe[:, 1::2] = sines
         pe[:, -1] = 1.0  # for bias.
@@ -1202,8 +1410,6 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
         p = p.permute(2, 1, 0, 3)  # (head, batch, time1, pos_head_dim)
         k = k.permute(2, 1, 3, 0)  # (head, batch, d_k, time2)
 
-        attn_scores = torch.matmul(q, k)
-
         use_pos_scores = False
         if torch.jit.is_scripting() or torch.jit.is_tracing():
             # We can't put random.random() in the same line
@@ -1230,10 +1436,12 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
                 (num_heads, batch_size, time1, n) = pos_scores.shape
                 rows = torch.arange(start=time1 - 1, end=-1, step=-1)
                 cols = torch.arange(seq_len)
-                rows = rows.repeat(batch_size * num_heads).unsqueeze(-1)
-                indexes = rows + cols
-                pos_scores = pos_scores.reshape(-1, n)
-                pos_scores = torch.gather(pos_scores, dim=1, index=indexes)
+                # the indexes are the same for all heads and sequences, so they
+                # are built once, of shape (time1, seq_len), and expanded.
+                indexes = rows.unsqueeze(-1) + cols
+                pos_scores = pos_scores.reshape(-1, time1, n)
+                indexes = indexes.expand(pos_scores.shape[0], time1, seq_len)
+                pos_scores = torch.gather(pos_scores, dim=2, index=indexes)
                 pos_scores = pos_scores.reshape(num_heads, batch_size, time1, seq_len)
             else:
                 pos_scores = pos_scores.as_strided(
@@ -1247,7 +1455,19 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
                     storage_offset=pos_scores.stride(3) * (seq_len - 1),
                 )
 
-            attn_scores = attn_scores + pos_scores
+            if torch.jit.is_tracing():
+                attn_scores = torch.matmul(q, k) + pos_scores
+            else:
+                # q k^T + pos_scores as one batched GEMM, which accumulates into
+                # a copy of pos_scores instead of allocating the product and
+                # then adding. Merging (head, batch) is a view of pos_scores.
+                attn_scores = torch.baddbmm(
+                    pos_scores.reshape(-1, seq_len, seq_len),
+                    q.reshape(-1, seq_len, query_head_dim),
+                    k.reshape(-1, query_head_dim, seq_len),
+                ).view(num_heads, batch_size, seq_len, seq_len)
+        else:
+            attn_scores = torch.matmul(q, k)
 
         if torch.jit.is_scripting() or torch.jit.is_tracing():
             pass
@@ -1272,21 +1492,25 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
 
         if attn_mask is not None:
             assert attn_mask.dtype == torch.bool
-            # use -1000 to avoid nan's where attn_mask and key_padding_mask make
-            # all scores zero.  It's important that this be large enough that exp(-1000)
-            # is exactly zero, for reasons related to const_attention_rate, it
-            # compares the final weights with zero.
-            attn_scores = attn_scores.masked_fill(attn_mask, -1000)
 
         if key_padding_mask is not None:
             assert key_padding_mask.shape == (
                 batch_size,
                 seq_len,
             ), key_padding_mask.shape
-            attn_scores = attn_scores.masked_fill(
-                key_padding_mask.unsqueeze(1),
-                -1000,
-            )
+            if attn_mask is None:
+                attn_mask = key_padding_mask.unsqueeze(1)
+            else:
+                # Merge the two masks, which are much smaller than attn_scores,
+                # so that attn_scores is only masked once.
+                attn_mask = attn_mask | key_padding_mask.unsqueeze(1)
+
+        if attn_mask is not None:
+            # use -1000 to avoid nan's where attn_mask and key_padding_mask make
+            # all scores zero.  It's important that this be large enough that exp(-1000)
+            # is exactly zero, for reasons related to const_attention_rate, it
+            # compares the final weights with zero.
+            attn_scores = attn_scores.masked_fill(attn_mask, -1000)
 
         # We use our own version of softmax, defined in scaling.py, which should
         # save a little of the memory used in backprop by, if we are in
@@ -1294,9 +1518,14 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
         # half-precision output for backprop purposes.
         attn_weights = softmax(attn_scores, dim=-1)
 
-        if torch.jit.is_scripting() or torch.jit.is_tracing():
+        if torch.jit.is_scripting() or torch.jit.is_tracing() or _is_compiling():
             pass
-        elif random.random() < 0.001 and not self.training:
+        elif (
+            not self.training
+            and logging.root.isEnabledFor(logging.DEBUG)
+            and random.random() < 0.001
+        ):
+            # The entropy is only computed if it is going to be logged.
             self._print_attn_entropy(attn_weights)
 
         attn_weights = nn.functional.dropout(
@@ -1654,12 +1883,27 @@ class ConvolutionModule(nn.Module):
 
         x = self.in_proj(x)  # (time, batch, 2*channels)
 
-        x, s = x.chunk(2, dim=2)
-        s = self.balancer1(s)
-        s = self.sigmoid(s)
-        x = self.activation1(x)  # identity.
-        x = x * s
-        x = self.activation2(x)  # identity
+        # At inference, the intermediate tensors are not needed for backward and
+        # can be reused.
+        is_inference = not (
+            x.requires_grad
+            or torch.jit.is_scripting()
+            or torch.jit.is_tracing()
+            or _is_compiling()
+        )
+
+        if is_inference:
+            # The balancer and the identities do nothing in the forward pass,
+            # and x * sigmoid(s) is exactly a gated linear unit, which glu()
+            # computes in one kernel that reads the output of in_proj once.
+            x = nn.functional.glu(x, dim=2)
+        else:
+            x, s = x.chunk(2, dim=2)
+            s = self.balancer1(s)
+            s = self.sigmoid(s)
+            x = self.activation1(x)  # identity.
+            x = x * s
+            x = self.activation2(x)  # identity
 
         # (time, batch, channels)
 
@@ -1667,14 +1911,23 @@ class ConvolutionModule(nn.Module):
         x = x.permute(1, 2, 0)  # (#batch, channels, time).
 
         if src_key_padding_mask is not None:
-            x = x.masked_fill(src_key_padding_mask.unsqueeze(1).expand_as(x), 0.0)
+            # (batch, 1, time), broadcast over the channels.
+            mask = src_key_padding_mask.unsqueeze(1)
+            if is_inference:
+                # x is the fresh output of glu(), so it can be masked in place.
+                x = x.masked_fill_(mask, 0.0)
+            else:
+                x = x.masked_fill(mask, 0.0)
 
         x = self.depthwise_conv(x)
 
-        x = self.balancer2(x)
+        # balancer2 and whiten only act in training.
+        if self.training:
+            x = self.balancer2(x)
         x = x.permute(2, 0, 1)  # (time, batch, channels)
 
-        x = self.whiten(x)  # (time, batch, channels)
+        if self.training:
+            x = self.whiten(x)  # (time, batch, channels)
         x = self.out_proj(x)  # (time, batch, channels)
 
         return x
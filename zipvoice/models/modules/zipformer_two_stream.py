@@ -15,10 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import math
 from typing import Optional, Tuple, Union
 
-import torch
 from torch import Tensor, nn
 
 from zipvoice.models.modules.scaling import FloatLike, ScheduledFloat, SwooshR
@@ -27,34 +25,14 @@ from zipvoice.models.modules.zipformer import (
     TTSZipformer,
     Zipformer2Encoder,
     Zipformer2EncoderLayer,
+    _autocast_context,
+    _use_compile,
+    compiled_timestep_embedding,
+    timestep_embedding,
+    timestep_freqs,
 )
 
 
-def timestep_embedding(timesteps, dim, max_period=10000):
-    """Create sinusoidal timestep embeddings.
-
-    :param timesteps: shape of (N) or (N, T)
-    :param dim: the dimension of the output.
-    :param max_period: controls the minimum frequency of the embeddings.
-    :return: an Tensor of positional embeddings. shape of (N, dim) or (T, N, dim)
-    """
-    half = dim // 2
-    freqs = torch.exp(
-        -math.log(max_period)
-        * torch.arange(start=0, end=half, dtype=torch.float32, device=timesteps.device)
-        / half
-    )
-
-    if timesteps.dim() == 2:
-        timesteps = timesteps.transpose(0, 1)  # (N, T) -> (T, N)
-
-    args = timesteps[..., None].float() * freqs[None]
-    embedding = torch.cat([torch.cos(args), torch.sin(args)], dim=-1)
-    if dim % 2:
-        embedding = torch.cat([embedding, torch.zeros_like(embedding[..., :1])], dim=-1)
-    return embedding
-
-
 class TTSZipformerTwoStream(TTSZipformer):
     """
     Args:
@@ -154,6 +132,16 @@ class TTSZipformerTwoStream(TTSZipformer):
             assert time_embed_dim != -1
         else:
             time_embed_dim = -1
+        # see enable_compile() and enable_autocast()
+        self.use_compile = False
+        self.autocast_dtype = None
+
+        # The frequencies of timestep_embedding(), not saved in the state dict
+        # and not used once cast to float16/bfloat16.
+        if self.use_time_embed:
+            self.register_buffer(
+                "time_freqs", timestep_freqs(time_embed_dim), persistent=False
+            )
 
         assert len(in_dim) == len(out_dim) == 2
 
@@ -240,25 +228,36 @@ class TTSZipformerTwoStream(TTSZipformer):
             index = 0
         else:
             index = 1
-        x = x.permute(1, 0, 2)
-        x = self.in_proj[index](x)
-
-        if t is not None:
-            assert t.dim() == 1 or t.dim() == 2, t.shape
-            time_emb = timestep_embedding(t, self.time_embed_dim)
-            time_emb = self.time_embed(time_emb)
-        else:
-            time_emb = None
+        in_dtype = x.dtype
+        with _autocast_context(self, x):
+            # Project in the (batch, time, channel) layout of the input, so that
+            # the matmul reads it contiguously, and only then switch to (time,
+            # batch, channel), which is a view.
+            x = self.in_proj[index](x).permute(1, 0, 2)
+
+            if t is not None:
+                assert t.dim() == 1 or t.dim() == 2, t.shape
+                embed_fn = (
+                    compiled_timestep_embedding
+                    if _use_compile(self)
+                    else timestep_embedding
+                )
+                time_emb = embed_fn(t, self.time_embed_dim, freqs=self.time_freqs)
+                time_emb = self.time_embed(time_emb)
+            else:
+                time_emb = None
 
-        attn_mask = None
+            attn_mask = None
 
-        for i, module in enumerate(self.encoders):
-            x = module(
-                x,
-                time_emb=time_emb,
-                src_key_padding_mask=padding_mask,
-                attn_mask=attn_mask,
-            )
-        x = self.out_proj[index](x)
-        x = x.permute(1, 0, 2)
+            for module in self.encoders:
+                x = module(
+                    x,
+                    time_emb=time_emb,
+                    src_key_padding_mask=padding_mask,
+                    attn_mask=attn_mask,
+                )
+            x = self.out_proj[index](x)
+            x = x.permute(1, 0, 2)
+        if x.dtype != in_dtype:
+            x = x.to(in_dtype)
         return x
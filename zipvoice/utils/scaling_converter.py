@@ -29,6 +29,7 @@ import torch
 import torch.nn as nn
 
 from zipvoice.models.modules.scaling import (
+    ActivationDropoutAndLinear,
     Balancer,
     Dropout3,
     SwooshL,
@@ -58,11 +59,27 @@ def get_submodule(model, target):
     return mod
 
 
+def split_activation_and_linear(m: ActivationDropoutAndLinear) -> nn.Sequential:
+    """Returns an nn.Sequential of the activation of `m` and an nn.Linear that
+    shares the parameters of `m`, equivalent to `m` at inference."""
+    if m.activation == "SwooshL":
+        activation = SwooshL()
+    else:
+        assert m.activation == "SwooshR", m.activation
+        activation = SwooshR()
+    out_channels, in_channels = m.weight.shape
+    linear = nn.Linear(in_channels, out_channels, bias=m.bias is not None)
+    linear.weight = m.weight
+    linear.bias = m.bias
+    return nn.Sequential(activation, linear)
+
+
 def convert_scaled_to_non_scaled(
     model: nn.Module,
     inplace: bool = False,
     is_pnnx: bool = False,
     is_onnx: bool = False,
+    split_activation_linear: bool = False,
 ):
     """
     Args:
@@ -75,6 +92,10 @@ def convert_scaled_to_non_scaled(
         True if we are going to export the model for PNNX.
       is_onnx:
         True if we are going to export the model for ONNX.
+      split_activation_linear:
+        If True, ActivationDropoutAndLinear is replaced by its activation
+        followed by an nn.Linear, e.g. so that
+        torch.ao.quantization.quantize_dynamic() quantizes the linear.
     Return:
       Return a model without scaled layers.
     """
@@ -94,6 +115,8 @@ def convert_scaled_to_non_scaled(
             # the input changes, so we have to use torch.jit.script()
             # to replace torch.jit.trace()
             d[name] = torch.jit.script(m)
+        elif split_activation_linear and isinstance(m, ActivationDropoutAndLinear):
+            d[name] = split_activation_and_linear(m)
 
     for k, v in d.items():
         if "." in k: